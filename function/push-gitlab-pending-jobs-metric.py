@@ -1,4 +1,5 @@
 #!/bin/python
+import json
 import logging
 import requests
 import time
@@ -6,64 +7,104 @@ import boto3
 import backoff
 import os
 import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
 
 MAX_RETRIES = 8
-ACTIVITY_SINCE = os.getenv('ACTIVITY_SINCE')
+# Upper bound on concurrent GitLab requests, the request rate is bounded separately by MAX_REQUESTS_PER_SECOND
+MAX_WORKERS = 8
+# Stay under the GitLab.com rate limit of ~10 requests per second across all of the workers
+MAX_REQUESTS_PER_SECOND = 10
+TOKEN_CACHE_TTL = 300
+PROJECT_IDS_CACHE_TTL = 120
+# Seconds of the invocation kept back from GitLab requests to publish the metrics
+RETRY_DEADLINE_MARGIN = 1
+ACTIVITY_SINCE = timedelta(hours=int(os.getenv('ACTIVITY_SINCE')))
 ALLOWED_IP_RANGE = os.getenv('ALLOWED_IP_RANGE', [])
 TOKEN_SSM_PATH = os.getenv('TOKEN_SSM_PATH')
 GITLAB_URI = os.getenv('GITLAB_URI')
 ASG_NAME = os.getenv('ASG_NAME')
 REGION = os.getenv('AWS_REGION')
 RUNNER_JOB_TAGS = [tag.strip() for tag in os.getenv('RUNNER_JOB_TAGS', default="").split(',')]
+RUNNER_JOB_TAGS_SET = frozenset(RUNNER_JOB_TAGS)
 HAS_RUNNER_TAGS = any(tag.strip() for tag in RUNNER_JOB_TAGS)
 RUNNERS_PER_INSTANCE = int(os.getenv('RUNNERS_PER_INSTANCE'))
 METRIC_NAMESPACE = os.getenv('METRIC_NAMESPACE')
-NARROW_TO_MEMBERSHIP_RAW = os.getenv('NARROW_TO_MEMBERSHIP')
-NARROW_TO_MEMBERSHIP = True if NARROW_TO_MEMBERSHIP_RAW.lower() == 'true' else False
-LOG_LEVEL_RAW = os.getenv('LOG_LEVEL')
-LOG_LEVEL = logging.INFO
-if LOG_LEVEL_RAW.lower() == 'debug':
-    LOG_LEVEL = logging.DEBUG
+# Defaults match the module variable defaults
+NARROW_TO_MEMBERSHIP = os.getenv('NARROW_TO_MEMBERSHIP', 'true').lower() == 'true'
+LOG_LEVEL = logging.DEBUG if os.getenv('LOG_LEVEL', 'info').lower() == 'debug' else logging.INFO
+
+PROJECTS_BASE_URL = '{}/api/v4/projects?pagination=keyset&per_page=100&order_by=id&sort=asc&simple=true{}'.format(GITLAB_URI, '&membership=true' if NARROW_TO_MEMBERSHIP else '')
 
 LOGGER = logging.getLogger('myLogger')
 LOGGER.setLevel(LOG_LEVEL)
 
+# Shared across the worker threads and warm invocations so connections to GitLab are kept alive and reused
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=0))
 
-def no_request_limit_exceeded_code(e):
-    return e.response.get('Error', {}).get('Code', 'Unknown') != 'RequestLimitExceeded'
+# Created once per container and reused by warm invocations. Adaptive retries back off and rate limit client side on throttling
+BOTO_CONFIG = Config(region_name=REGION, retries={'max_attempts': MAX_RETRIES, 'mode': 'adaptive'})
+SSM_CLIENT = boto3.client('ssm', config=BOTO_CONFIG)
+ASG_CLIENT = boto3.client('autoscaling', config=BOTO_CONFIG)
+_TOKEN_CACHE = {'value': None, 'expires': 0}
+_PROJECT_IDS_CACHE = {'ids': None, 'expires': 0}
+_RETRY_DEADLINE = {'time': 0}
 
 
-@backoff.on_exception(backoff.expo,
-                      ClientError,
-                      max_tries=MAX_RETRIES,
-                      giveup=no_request_limit_exceeded_code)
-def get_parameter(ssm_client, **kwargs):
-    return ssm_client.get_parameter(**kwargs)
+_REQUEST_SLOT_LOCK = threading.Lock()
+_NEXT_REQUEST_SLOT = {'time': 0}
 
 
-@backoff.on_exception(backoff.expo,
-                      ClientError,
-                      max_tries=MAX_RETRIES,
-                      giveup=no_request_limit_exceeded_code)
-def put_metric_data(cw_client, **kwargs):
-    return cw_client.put_metric_data(**kwargs)
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__('GitLab rate limit exceeded, retry after {} seconds'.format(retry_after))
+        self.retry_after = retry_after
 
 
-@backoff.on_exception(backoff.expo,
-                      ClientError,
-                      max_tries=MAX_RETRIES,
-                      giveup=no_request_limit_exceeded_code)
-def describe_auto_scaling_groups(asg_client, **kwargs):
-    return asg_client.describe_auto_scaling_groups(**kwargs)
+def wait_for_request_slot():
+    # Hand out evenly spaced start times so the workers together never exceed MAX_REQUESTS_PER_SECOND
+    with _REQUEST_SLOT_LOCK:
+        now = time.monotonic()
+        slot = max(now, _NEXT_REQUEST_SLOT['time'])
+        _NEXT_REQUEST_SLOT['time'] = slot + 1.0 / MAX_REQUESTS_PER_SECOND
+    if slot > now:
+        time.sleep(slot - now)
+
 
+def get_remaining_retry_time():
+    return max(_RETRY_DEADLINE['time'] - time.time(), 0)
 
-@backoff.on_exception(backoff.expo,
-                      requests.exceptions.Timeout,
-                      max_tries=MAX_RETRIES)
-def get_request(*args, **kwargs):
-    return requests.get(*args, **kwargs)
+
+def get_retry_wait(e):
+    return e.retry_after if isinstance(e, RateLimited) else 1
+
+
+# Retries are bounded by the time left in the invocation rather than only the number of attempts
+@backoff.on_exception(backoff.runtime,
+                      (requests.exceptions.Timeout, RateLimited),
+                      value=get_retry_wait,
+                      jitter=None,
+                      max_tries=MAX_RETRIES,
+                      max_time=get_remaining_retry_time)
+def get_request(url, **kwargs):
+    wait_for_request_slot()
+    remaining = get_remaining_retry_time()
+    if not remaining:
+        raise Exception('No time left in this invocation to request {}'.format(url))
+    res = SESSION.get(url, timeout=remaining, **kwargs)
+    # A throttled request must not be treated as having no jobs, otherwise the runners would scale in under load
+    if res.status_code == 429:
+        retry_after_raw = res.headers.get('Retry-After', '1')
+        retry_after = int(retry_after_raw) if retry_after_raw.isdigit() else 1
+        remaining = get_remaining_retry_time()
+        if retry_after >= remaining:
+            raise Exception('GitLab rate limited {} and asked to retry after {} seconds, exceeding the {:.1f} seconds left in this invocation'.format(url, retry_after, remaining))
+        raise RateLimited(retry_after)
+    return res
 
 
 def check_ip(SOURCE_IP_ADDRESS, ALLOWED_IP_RANGE):
@@ -83,91 +124,100 @@ def check_ip(SOURCE_IP_ADDRESS, ALLOWED_IP_RANGE):
     return False
 
 
-def get_all_project_ids(token):
+def get_token():
+    now = time.time()
+    if now >= _TOKEN_CACHE['expires']:
+        result = SSM_CLIENT.get_parameter(Name=TOKEN_SSM_PATH, WithDecryption=True)
+        _TOKEN_CACHE['value'] = result['Parameter']['Value']
+        _TOKEN_CACHE['expires'] = now + TOKEN_CACHE_TTL
+    else:
+        LOGGER.debug("Using cached GitLab token")
+    return _TOKEN_CACHE['value']
+
+
+def get_all_project_ids(use_cache):
+    now = time.time()
+    if use_cache and now < _PROJECT_IDS_CACHE['expires']:
+        LOGGER.info("Using cached project ids: {}".format(_PROJECT_IDS_CACHE['ids']))
+        return _PROJECT_IDS_CACHE['ids']
     project_ids = []
-    link = '{}/api/v4/projects?pagination=keyset&per_page=50&order_by=id&sort=asc&simple=true{}'.format(GITLAB_URI, '&membership=true' if NARROW_TO_MEMBERSHIP else '')
-    now = datetime.utcnow()
-    hours_ago = now - timedelta(hours=int(ACTIVITY_SINCE))
+    hours_ago = datetime.utcnow() - ACTIVITY_SINCE
     hours_ago_timestamp_str = '{}Z'.format(hours_ago.isoformat(timespec='seconds'))
+    # Let GitLab filter out the projects without recent activity rather than paging through all of them
+    link = '{}&last_activity_after={}'.format(PROJECTS_BASE_URL, hours_ago_timestamp_str)
     LOGGER.info("Searching for projects with last activity after {}".format(hours_ago_timestamp_str))
     total_numb_of_projects = 0
     while True:
-        res = get_request(link, headers={'PRIVATE-TOKEN': token})
+        res = get_request(link)
         if res.status_code != 200:
             raise Exception('Error retrieving all the projects')
-        total_numb_of_projects += len(res.json())
-        for project in res.json():
-            pid = project['id']
-            last_activity_str = project['last_activity_at']
-            last_activity = datetime.strptime(last_activity_str, '%Y-%m-%dT%H:%M:%S.%fZ')
-            if last_activity > hours_ago:
-                LOGGER.debug('Found project with last activity {}'.format(last_activity_str))
-                project_ids.extend([pid])
-        if 'Link' not in res.headers:
+        projects = res.json()
+        total_numb_of_projects += len(projects)
+        for project in projects:
+            LOGGER.debug('Found project with last activity {}'.format(project['last_activity_at']))
+            project_ids.append(project['id'])
+        next_link = res.links.get('next', {}).get('url')
+        if not next_link:
             break
-        link = res.headers['Link'].split('<')[1].split('>')[0]
+        link = next_link
     LOGGER.info("Found project ids: {}".format(project_ids))
     LOGGER.info("Number of projects processes: {}".format(total_numb_of_projects))
+    _PROJECT_IDS_CACHE['ids'] = project_ids
+    _PROJECT_IDS_CACHE['expires'] = now + PROJECT_IDS_CACHE_TTL
     return project_ids
 
 
-def get_pending_jobs(project_id, token):
-    res = get_request('{uri}/api/v4/projects/{pid}/jobs?scope[]=pending'.format(uri=GITLAB_URI, pid=project_id),
-                      headers={'PRIVATE-TOKEN': token})
-    if res.status_code != 200:
-        LOGGER.error('Error retrieving the jobs of the project id %s. Return code: %s' % (project_id, res.status_code))
-        return []
-        # raise Exception('Error retrieving the jobs of the project id %s' % project_id)
-    job_tag_list = []
-    for job in res.json():
-        # Ensure the runner tags contains all of the job tags
-        if all(item in RUNNER_JOB_TAGS for item in list(filter(None, job['tag_list']))):
-            job_tag_list.append(job)
-    return job_tag_list
-
-
-def get_running_jobs(project_id, token):
-    res = get_request('{uri}/api/v4/projects/{pid}/jobs?scope[]=running'.format(uri=GITLAB_URI, pid=project_id),
-                      headers={'PRIVATE-TOKEN': token})
-    if res.status_code != 200:
-        LOGGER.error('Error retrieving the jobs of the project id %s. Return code: %s' % (project_id, res.status_code))
-        return []
-        # raise Exception('Error retrieving the jobs of the project id %s' % project_id)
-    # If the job requires runner tags, heck the lambda tags have them all
-    job_tag_list = []
-    for job in res.json():
-        # Ensure the runner tags contains all of the job tags
-        if all(item in RUNNER_JOB_TAGS for item in list(filter(None, job['tag_list']))):
-            job_tag_list.append(job)
-    return job_tag_list
-
-
-def get_all_pending_and_running_job_ids(token):
-    pending_job_ids = []
-    running_job_ids = []
-    project_ids = get_all_project_ids(token)
-    for project_id in project_ids:
-        pending_jobs = get_pending_jobs(project_id, token)
-        running_jobs = get_running_jobs(project_id, token)
-        tag_log = " with {} {}".format("tags" if len(RUNNER_JOB_TAGS) > 1 else "tag", ' or '.join(f'"{item}"' for item in RUNNER_JOB_TAGS)) if HAS_RUNNER_TAGS else ""
-        if len(pending_jobs):
-            LOGGER.info("Number of pending jobs for project id {}: {}{}".format(project_id, len(pending_jobs),  tag_log))
-            pending_job_ids.extend(pending_job['id'] for pending_job in pending_jobs)
-        if len(running_jobs):
-            LOGGER.info("Number of running jobs for project id {}: {}".format(project_id, len(running_jobs),  tag_log))
-            running_job_ids.extend(running_job['id'] for running_job in running_jobs)
-    return pending_job_ids, running_job_ids
-
-
-def get_number_of_pending_and_running_jobs(token):
-    pending_job_ids, running_job_ids = get_all_pending_and_running_job_ids(token)
-    return len(pending_job_ids), len(running_job_ids)
+def get_job_counts(project_id):
+    pending_jobs = 0
+    running_jobs = 0
+    link = '{uri}/api/v4/projects/{pid}/jobs?scope[]=pending&scope[]=running&per_page=100'.format(uri=GITLAB_URI, pid=project_id)
+    # Both scopes share the pages, newest first, so follow every page to avoid missing older pending jobs
+    while link:
+        res = get_request(link)
+        if res.status_code != 200:
+            LOGGER.error('Error retrieving the jobs of the project id %s. Return code: %s' % (project_id, res.status_code))
+            break
+            # raise Exception('Error retrieving the jobs of the project id %s' % project_id)
+        for job in res.json():
+            # Ensure the runner tags contains all of the job tags
+            if not RUNNER_JOB_TAGS_SET.issuperset(filter(None, job['tag_list'])):
+                continue
+            if job['status'] == 'pending':
+                pending_jobs += 1
+            elif job['status'] == 'running':
+                running_jobs += 1
+        link = res.links.get('next', {}).get('url')
+    return pending_jobs, running_jobs
+
+
+def get_number_of_pending_and_running_jobs(use_project_ids_cache):
+    pending_count = 0
+    running_count = 0
+    project_ids = get_all_project_ids(use_project_ids_cache)
+    tag_log = " with {} {}".format("tags" if len(RUNNER_JOB_TAGS) > 1 else "tag", ' or '.join(f'"{item}"' for item in RUNNER_JOB_TAGS)) if HAS_RUNNER_TAGS else ""
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(get_job_counts, project_id): project_id for project_id in project_ids}
+        for future in as_completed(futures):
+            project_id = futures[future]
+            try:
+                pending_jobs, running_jobs = future.result()
+            except Exception:
+                # The invocation has failed, so stop the queued projects from calling GitLab while it throttles us
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            if pending_jobs:
+                LOGGER.info("Number of pending jobs for project id {}: {}{}".format(project_id, pending_jobs, tag_log))
+                pending_count += pending_jobs
+            if running_jobs:
+                LOGGER.info("Number of running jobs for project id {}: {}{}".format(project_id, running_jobs, tag_log))
+                running_count += running_jobs
+    return pending_count, running_count
 
 
 def get_asg_healthy_instances_in_service(asg_client):
     instances_in_service = 0
     LOGGER.info("Listing instances in autoscaling group {}".format(ASG_NAME))
-    result = describe_auto_scaling_groups(asg_client, AutoScalingGroupNames=[ASG_NAME])
+    result = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[ASG_NAME])
     instances = result['AutoScalingGroups'][0].get('Instances', [])
     LOGGER.info("Number of instances: {}".format(len(instances)))
     for instance in instances:
@@ -179,6 +229,30 @@ def get_asg_healthy_instances_in_service(asg_client):
     return instances_in_service
 
 
+def put_metric(name, value, unit, dimension_name, dimension_value, timestamp):
+    # Embedded metric format, CloudWatch Logs extracts the metric from the log line so no API call is needed
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(timestamp * 1000),
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': METRIC_NAMESPACE,
+                    'Dimensions': [[dimension_name]],
+                    'Metrics': [
+                        {
+                            'Name': name,
+                            'Unit': unit,
+                            'StorageResolution': 60
+                        }
+                    ]
+                }
+            ]
+        },
+        dimension_name: dimension_value,
+        name: value
+    }))
+
+
 def handler(event, context):
     # Check if request originated from http (url), if it did and we have IPs to check verify the source is allowed
     if 'requestContext' in event and 'http' in event['requestContext'] and 'sourceIp' in event['requestContext']['http'] and ALLOWED_IP_RANGE:
@@ -188,17 +262,21 @@ def handler(event, context):
                 "body": '',
             }
 
-    ssm_client = boto3.client('ssm', region_name=REGION)
-    result = get_parameter(ssm_client, Name=TOKEN_SSM_PATH, WithDecryption=True)
-    token = result['Parameter']['Value']
+    _RETRY_DEADLINE['time'] = time.time() + context.get_remaining_time_in_millis() / 1000 - RETRY_DEADLINE_MARGIN
+    SESSION.headers['PRIVATE-TOKEN'] = get_token()
+
+    # A webhook may be the first activity of a project missing from the cached ids and there may be no polling
+    # to pick it up later, so only scheduled invocations reuse the cached project ids
+    use_project_ids_cache = 'requestContext' not in event
 
-    pending_jobs, running_jobs = get_number_of_pending_and_running_jobs(token)
+    # The autoscaling group lookup is independent of GitLab so run it while the jobs are being counted
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        healthy_instances_future = executor.submit(get_asg_healthy_instances_in_service, ASG_CLIENT)
+        pending_jobs, running_jobs = get_number_of_pending_and_running_jobs(use_project_ids_cache)
+        healthy_instances_in_service = healthy_instances_future.result()
     tag_log = " with {} {}".format("tags" if len(RUNNER_JOB_TAGS) > 1 else "tag", ' or '.join(f'"{item}"' for item in RUNNER_JOB_TAGS)) if HAS_RUNNER_TAGS else ""
     LOGGER.info("Total number of pending jobs: {}{}".format(pending_jobs, tag_log))
     LOGGER.info("Total number of running jobs: {}{}".format(running_jobs, tag_log))
-
-    asg_client = boto3.client('autoscaling', region_name=REGION)
-    healthy_instances_in_service = get_asg_healthy_instances_in_service(asg_client)
     LOGGER.info("Number of HEALTHY instances: {}".format(healthy_instances_in_service))
 
     runners_overall_load = 100
@@ -206,51 +284,7 @@ def handler(event, context):
         runners_overall_load = float(100 * (pending_jobs + running_jobs)) / float(healthy_instances_in_service * RUNNERS_PER_INSTANCE)
     LOGGER.info("Runners overall load: {}".format(runners_overall_load))
 
-    cw_client = boto3.client('cloudwatch', region_name=REGION)
     timestamp = time.time()
-
-    put_metric_data(
-        cw_client,
-        Namespace=METRIC_NAMESPACE,
-        MetricData=[
-            {
-                'MetricName': 'NumberOfPendingJobs',
-                'Dimensions': [
-                    {
-                        'Name': 'Job Status',
-                        'Value': 'Pending'
-                    }
-                ],
-                'Timestamp': timestamp,
-                'Value': pending_jobs,
-                'Unit': 'Count',
-                'StorageResolution': 60
-            },
-            {
-                'MetricName': 'NumberOfRunningJobs',
-                'Dimensions': [
-                    {
-                        'Name': 'Job Status',
-                        'Value': 'Running'
-                    }
-                ],
-                'Timestamp': timestamp,
-                'Value': running_jobs,
-                'Unit': 'Count',
-                'StorageResolution': 60
-            },
-            {
-                'MetricName': 'RunnersOverallLoad',
-                'Dimensions': [
-                    {
-                        'Name': 'Runners Overall Load',
-                        'Value': 'OverallLoadPercentage'
-                    }
-                ],
-                'Timestamp': timestamp,
-                'Value': runners_overall_load,
-                'Unit': 'Percent',
-                'StorageResolution': 60
-            },
-        ]
-    )
+    put_metric('NumberOfPendingJobs', pending_jobs, 'Count', 'Job Status', 'Pending', timestamp)
+    put_metric('NumberOfRunningJobs', running_jobs, 'Count', 'Job Status', 'Running', timestamp)
+    put_metric('RunnersOverallLoad', runners_overall_load, 'Percent', 'Runners Overall Load', 'OverallLoadPercentage', timestamp)
@@ -92,7 +92,6 @@ data "aws_iam_policy_document" "lambda_gitlab_metric" {
   statement {
     actions = [
       "ssm:DescribeParameters",
-      "cloudwatch:PutMetricData",
       "autoscaling:DescribeAutoScalingGroups",
     ]
     effect    = "Allow"